@@ -2,24 +2,72 @@
 """
 Flask API for Medical-Clarity
 Connects Next.js UI to MedSAM2 + MedGemma pipeline
+
+Development:  python api.py
+Production:   gunicorn -w 1 -k gthread --threads 4 -b 0.0.0.0:8000 api:app
+
+Every worker process loads its own copy of both models, so use one worker
+per GPU (a single worker on Apple Silicon / MPS); threads overlap I/O and
+let one job segment while another is waiting on MedGemma.
 """
 
 import os
-import json
+import shutil
 import tempfile
-from flask import Flask, request, jsonify
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import orjson
+from flask import Flask, Response, request, jsonify, send_from_directory, url_for
 from flask_cors import CORS
 from pathlib import Path
-import subprocess
-import sys
+
+from complete_pipeline import OUTPUT_VISUALIZATION, get_mask_generator, run
+from medgemma_local import get_medgemma
 
 app = Flask(__name__)
 CORS(app)  # Allow requests from Next.js (localhost:3000)
 
 # Paths
-PIPELINE_SCRIPT = os.path.join(os.path.dirname(__file__), "complete_pipeline.py")
 DEMO_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "..", "web-app", "public", "demo", "ankle")
 UPLOAD_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "userOutput")
+os.makedirs(UPLOAD_OUTPUT_DIR, exist_ok=True)
+
+# Job scheduling
+ANALYZE_WORKERS = int(os.environ.get("ANALYZE_WORKERS", "2"))  # Concurrent pipeline runs
+ANALYZE_MAX_PENDING = int(os.environ.get("ANALYZE_MAX_PENDING", "4"))  # Running + queued
+JOB_TTL_MINUTES = int(os.environ.get("JOB_TTL_MINUTES", "30"))  # Keep job outputs this long
+CLEANUP_INTERVAL_SECONDS = 60
+
+# Load both models once so requests don't pay the startup cost
+app.config["MASK_GENERATOR"] = get_mask_generator()
+get_medgemma()
+
+executor = ThreadPoolExecutor(max_workers=ANALYZE_WORKERS)
+job_slots = threading.BoundedSemaphore(ANALYZE_MAX_PENDING)
+
+
+def cleanup_old_jobs():
+    """Periodically delete job folders older than JOB_TTL_MINUTES"""
+    while True:
+        cutoff = time.time() - JOB_TTL_MINUTES * 60
+        try:
+            for entry in os.scandir(UPLOAD_OUTPUT_DIR):
+                if (
+                    entry.is_dir()
+                    and entry.name.startswith("job_")
+                    and entry.stat().st_mtime < cutoff
+                ):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError as e:
+            # Keep the thread alive - a failed pass is retried next interval
+            print(f"Job cleanup error: {str(e)}")
+        time.sleep(CLEANUP_INTERVAL_SECONDS)
+
+
+threading.Thread(target=cleanup_old_jobs, daemon=True).start()
 
 
 @app.route("/health", methods=["GET"])
@@ -28,6 +76,12 @@ def health():
     return jsonify({"status": "ok", "message": "Medical-Clarity API is running"})
 
 
+@app.route("/output/<path:name>", methods=["GET"])
+def output_file(name):
+    """Serve files produced by the pipeline (supports caching and ranges)"""
+    return send_from_directory(UPLOAD_OUTPUT_DIR, name, conditional=True)
+
+
 @app.route("/analyze", methods=["POST"])
 def analyze():
     """
@@ -46,160 +100,96 @@ def analyze():
     if file.filename == "":
         return jsonify({"error": "Empty filename"}), 400
     
-    # Save uploaded file temporarily
+    # Don't let uploads pile up behind the running jobs
+    if not job_slots.acquire(blocking=False):
+        return jsonify({"error": "Server busy, try again shortly"}), 503
+    
     try:
-        # Create temp file with proper extension
-        suffix = Path(file.filename).suffix or ".png"
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            tmp_path = tmp.name
-            file.save(tmp_path)
-        
-        print(f"Saved uploaded file to: {tmp_path}")
+        # Decode the upload in memory - nothing is written to disk first
+        data = np.frombuffer(file.stream.read(), np.uint8)
+        image = cv2.imdecode(data, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            return jsonify({"error": "Could not decode image"}), 400
         
         # Run the pipeline
         print("Running MedSAM2 + MedGemma pipeline...")
-        result = run_pipeline(tmp_path)
-        
-        # Clean up temp file
-        os.unlink(tmp_path)
+        job_id, result = executor.submit(
+            run_pipeline, image, Path(file.filename).stem
+        ).result()
+        
+        # Built here - the pool thread has no app/request context.
+        # Absolute URL so the UI (served from another origin) can load it
+        result["visualization"] = url_for(
+            "output_file", name=f"{job_id}/{OUTPUT_VISUALIZATION}", _external=True
+        )
         
-        return jsonify(result)
+        # Results still hold NumPy scalars from the pipeline
+        return Response(
+            orjson.dumps(result, option=orjson.OPT_SERIALIZE_NUMPY),
+            mimetype="application/json",
+        )
         
     except Exception as e:
         print(f"Error: {str(e)}")
         import traceback
         traceback.print_exc()
         
-        # Clean up on error
-        if os.path.exists(tmp_path):
-            os.unlink(tmp_path)
-        
         return jsonify({"error": str(e)}), 500
+    
+    finally:
+        job_slots.release()
 
 
-def run_pipeline(image_path):
+def run_pipeline(image, image_name):
     """
-    Run complete_pipeline.py on the uploaded image
+    Run the MedSAM2 + MedGemma pipeline on the decoded grayscale upload
     
-    Returns: Dictionary with analysis results
+    Returns: (job_id, dictionary with analysis results). The caller adds
+    the "visualization" URL, which needs the request context.
     """
     
-    pipeline_dir = os.path.dirname(PIPELINE_SCRIPT)
+    # Separate output folder per request so concurrent jobs don't clobber
+    job_dir = tempfile.mkdtemp(prefix="job_", dir=UPLOAD_OUTPUT_DIR)
+    job_id = os.path.basename(job_dir)
     
-    # Create userOutput folder
-    os.makedirs(UPLOAD_OUTPUT_DIR, exist_ok=True)
+    data = run(
+        image, job_dir, app.config["MASK_GENERATOR"], image_name=image_name
+    )
     
-    # Copy uploaded image to pipeline folder as upload.png
-    import shutil
-    upload_input_path = os.path.join(pipeline_dir, "upload.png")
-    shutil.copy(image_path, upload_input_path)
+    # Convert to frontend format
+    regions = []
+    for region in data.get("regions", []):
+        regions.append({
+            "id": region.get("id", ""),
+            "number": region.get("number", 0),
+            "label": region.get("label", ""),
+            "mentioned": region.get("mentioned_in_diagnosis", False),
+            "color": region.get("color", [128, 128, 128]),
+            "bbox": region.get("bbox", [0, 0, 0, 0]),
+            "center": region.get("center", [0, 0])
+        })
     
-    # Modify pipeline script to use upload.png and output to userOutput
-    # We'll do this by temporarily modifying the INPUT and OUTPUT variables
-    pipeline_backup = PIPELINE_SCRIPT + ".backup"
-    shutil.copy(PIPELINE_SCRIPT, pipeline_backup)
+    # Get diagnosis text
+    diagnosis_text = data.get("diagnosis", {}).get("full_report", "")
     
-    try:
-        # Read pipeline script
-        with open(PIPELINE_SCRIPT, 'r') as f:
-            pipeline_code = f.read()
-        
-        # Replace paths
-        modified_code = pipeline_code.replace(
-            'DEMO_INPUT_IMAGE = os.path.join(BASE_DIR, "ankle.png")',
-            'DEMO_INPUT_IMAGE = os.path.join(BASE_DIR, "upload.png")'
-        )
-        modified_code = modified_code.replace(
-            'DEMO_OUTPUT_DIR = os.path.join(BASE_DIR, "..", "web-app", "public", "demo", "ankle")',
-            f'DEMO_OUTPUT_DIR = "{UPLOAD_OUTPUT_DIR}"'
-        )
-        
-        # Write modified pipeline
-        with open(PIPELINE_SCRIPT, 'w') as f:
-            f.write(modified_code)
-        
-        # Run pipeline
-        env = os.environ.copy()
-        env["PYTHONUNBUFFERED"] = "1"
-        
-        process = subprocess.Popen(
-            [sys.executable, PIPELINE_SCRIPT],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            env=env,
-            cwd=pipeline_dir
-        )
-        
-        # Stream output
-        for line in process.stdout:
-            print(line, end="")
-        
-        process.wait()
-        
-        if process.returncode != 0:
-            raise Exception(f"Pipeline failed with code {process.returncode}")
-        
-        # Read output files from userOutput
-        output_json_path = os.path.join(UPLOAD_OUTPUT_DIR, "data.json")
-        output_viz_path = os.path.join(UPLOAD_OUTPUT_DIR, "annotated_visualization.png")
-        output_original_path = os.path.join(UPLOAD_OUTPUT_DIR, "upload.png")
-        
-        if not os.path.exists(output_json_path):
-            raise Exception(f"Pipeline did not generate output JSON at {output_json_path}")
-        
-        # Load results
-        with open(output_json_path, "r") as f:
-            data = json.load(f)
-        
-        # Convert to frontend format
-        regions = []
-        for region in data.get("regions", []):
-            regions.append({
-                "id": region.get("id", ""),
-                "number": region.get("number", 0),
-                "label": region.get("label", ""),
-                "mentioned": region.get("mentioned_in_diagnosis", False),
-                "color": region.get("color", [128, 128, 128]),
-                "bbox": region.get("bbox", [0, 0, 0, 0]),
-                "center": region.get("center", [0, 0])
-            })
-        
-        # Get diagnosis text
-        diagnosis_text = data.get("diagnosis", {}).get("full_report", "")
-        
-        # Read original uploaded image as base64
-        import base64
-        with open(output_original_path, "rb") as f:
-            original_base64 = base64.b64encode(f.read()).decode("utf-8")
-        
-        response = {
-            "visualization": f"data:image/png;base64,{original_base64}",
-            "regions": regions,
-            "diagnosis": diagnosis_text,
-            "metadata": data.get("image_info", {})
-        }
-        
-        return response
-        
-    finally:
-        # Restore original pipeline script
-        shutil.move(pipeline_backup, PIPELINE_SCRIPT)
-        
-        # Clean up upload input
-        if os.path.exists(upload_input_path):
-            os.unlink(upload_input_path)
+    response = {
+        "regions": regions,
+        "diagnosis": diagnosis_text,
+        "metadata": data.get("image_info", {})
+    }
+    
+    return job_id, response
 
 
 if __name__ == "__main__":
     print("=" * 60)
     print("Medical-Clarity API Server")
     print("=" * 60)
-    print(f"Pipeline: {PIPELINE_SCRIPT}")
     print(f"Demo output: {DEMO_OUTPUT_DIR}")
     print(f"Upload output: {UPLOAD_OUTPUT_DIR}")
-    print("\nStarting server on http://localhost:8000")
+    print("\nStarting development server on http://localhost:8000")
     print("Ready to accept MRI uploads from Next.js UI")
+    print("(use gunicorn for production, see module docstring)")
     print("=" * 60)
     
-    app.run(host="0.0.0.0", port=8000, debug=True)
+    app.run(host="0.0.0.0", port=8000, threaded=True)
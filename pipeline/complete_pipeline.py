@@ -13,21 +13,32 @@ Flow:
 This enables real-time highlighting of regions as diagnosis is read.
 """
 
-import json
+import argparse
+import hashlib
 import os
 import re
+import threading
+from collections import OrderedDict, namedtuple
 from pathlib import Path
 
 import cv2
 import numpy as np
+import orjson
 import torch
 from hydra import initialize_config_dir
 from hydra.core.global_hydra import GlobalHydra
+from PIL import Image
 
 # Import local MedGemma
 from medgemma_local import ask_medgemma
 from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
 from sam2.build_sam import build_sam2
+from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None  # Optional: pure NumPy overlap filtering is used instead
 
 # =============================================================================
 # CONFIGURATION
@@ -38,34 +49,89 @@ CONFIG_DIR = os.path.join(BASE_DIR, "sam2", "configs")
 MODEL_CFG = "sam2.1_hiera_t512.yaml"
 CHECKPOINT = os.path.join(BASE_DIR, "checkpoints", "MedSAM2_latest.pt")
 
-# Input/Output paths - DEMO ONLY (hardcoded for demo generation)
+# Default input/output paths - used when generating the demo
 DEMO_INPUT_IMAGE = os.path.join(BASE_DIR, "ankle.png")
 
 # Save directly to web-app demo folder
 DEMO_OUTPUT_DIR = os.path.join(BASE_DIR, "..", "web-app", "public", "demo", "ankle")
-os.makedirs(DEMO_OUTPUT_DIR, exist_ok=True)
 
-DEMO_OUTPUT_VISUALIZATION = os.path.join(DEMO_OUTPUT_DIR, "annotated_visualization.png")
-DEMO_OUTPUT_JSON = os.path.join(DEMO_OUTPUT_DIR, "data.json")
-DEMO_OUTPUT_DIAGNOSIS = os.path.join(DEMO_OUTPUT_DIR, "diagnosis_report.txt")
-DEMO_OUTPUT_ORIGINAL = os.path.join(DEMO_OUTPUT_DIR, "ankle.png")  # Copy of original
+# Output file names (written inside the chosen output directory)
+OUTPUT_VISUALIZATION = "annotated_visualization.png"
+OUTPUT_JSON = "data.json"
+OUTPUT_DIAGNOSIS = "diagnosis_report.txt"
 
 DEVICE = "mps" if torch.backends.mps.is_available() else "cpu"
 
+# The mask generator keeps per-image state, so only one segmentation at a time
+_segment_lock = threading.Lock()
+
+# Image encoder outputs kept in memory (one entry per crop; crop_n_layers=1
+# gives 5 crops per image)
+EMBEDDING_CACHE_SIZE = 16
+
+# From this many regions on, centroids come from whole-image bincounts
+# instead of per-region moments over each bbox
+BINCOUNT_CENTROIDS_MIN_REGIONS = 32
+
 # =============================================================================
 # STEP 1: SEGMENT WITH MedSAM2
 # =============================================================================
 
-
-def segment_image(image_path):
-    """Segment MRI image using MedSAM2."""
-    print("\n" + "=" * 60)
-    print("STEP 1: Segmenting with MedSAM2")
-    print("=" * 60)
-
-    if GlobalHydra.instance().is_initialized():
-        GlobalHydra.instance().clear()
-    initialize_config_dir(config_dir=CONFIG_DIR, version_base="1.2")
+# Masks as one array per field. order holds the indices of the regions in
+# use, largest first - it is the region numbering used everywhere downstream.
+MaskSet = namedtuple("MaskSet", "segs bboxes areas ious stabilities order")
+
+
+def to_mask_set(masks, image_shape):
+    """Convert SAM2 mask records into a MaskSet."""
+    if masks:
+        segs = np.stack([m["segmentation"] for m in masks])
+    else:
+        segs = np.zeros((0, *image_shape[:2]), dtype=bool)
+    bboxes = np.array([m["bbox"] for m in masks], dtype=np.int32).reshape(-1, 4)
+    areas = np.array([m["area"] for m in masks], dtype=np.int32)
+    ious = np.array([m["predicted_iou"] for m in masks], dtype=np.float64)
+    stabilities = np.array([m["stability_score"] for m in masks], dtype=np.float64)
+    order = np.argsort(-areas, kind="stable")
+    return MaskSet(segs, bboxes, areas, ious, stabilities, order)
+
+
+class CachedSAM2ImagePredictor(SAM2ImagePredictor):
+    """SAM2ImagePredictor that reuses image embeddings for repeated images.
+
+    Embeddings are keyed by a blake2b hash of the image bytes and evicted
+    least-recently-used once more than cache_size entries are stored.
+    """
+
+    def __init__(self, sam_model, cache_size=EMBEDDING_CACHE_SIZE, **kwargs):
+        super().__init__(sam_model, **kwargs)
+        self.cache_size = cache_size
+        self._embedding_cache = OrderedDict()
+
+    @torch.no_grad()
+    def set_image(self, image):
+        if not isinstance(image, np.ndarray):
+            return super().set_image(image)
+
+        key = (image.shape, hashlib.blake2b(image.tobytes(), digest_size=8).digest())
+        cached = self._embedding_cache.get(key)
+        if cached is not None:
+            self._embedding_cache.move_to_end(key)
+            self.reset_predictor()
+            self._features, self._orig_hw = cached
+            self._is_image_set = True
+            return
+
+        super().set_image(image)
+        self._embedding_cache[key] = (self._features, self._orig_hw)
+        if len(self._embedding_cache) > self.cache_size:
+            self._embedding_cache.popitem(last=False)
+
+
+def load_mask_generator():
+    """Build the MedSAM2 automatic mask generator."""
+    if not GlobalHydra.instance().is_initialized():
+        initialize_config_dir(config_dir=CONFIG_DIR, version_base="1.2")
 
     print("Loading MedSAM2...")
     sam2_model = build_sam2(
@@ -82,59 +148,120 @@ def segment_image(image_path):
         crop_n_points_downscale_factor=2,
         min_mask_region_area=200,    # Lowered from 150 to catch smaller structures
     )
+    # Same predictor settings, plus the embedding cache. A fresh cache comes
+    # with every model load.
+    mask_generator.predictor = CachedSAM2ImagePredictor(
+        sam2_model,
+        max_hole_area=mask_generator.min_mask_region_area,
+        max_sprinkle_area=mask_generator.min_mask_region_area,
+    )
 
-    print(f"Loading image: {image_path}")
-    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-    image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX)
-    image_rgb = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
-
-    print("Running segmentation...")
-    masks = mask_generator.generate(image_rgb)
+    print("✓ MedSAM2 loaded successfully!")
+    return mask_generator
 
-    print(f"✓ Found {len(masks)} regions")
-    return masks, image_rgb
 
+_mask_generator = None
+_mask_generator_lock = threading.Lock()
 
-def remove_overlapping_regions(masks, iou_threshold=0.3):
-    """Remove overlapping masks."""
-    print("\nRemoving overlapping regions...")
 
-    def compute_iou(box1, box2):
-        x1, y1, w1, h1 = box1
-        x2, y2, w2, h2 = box2
+def get_mask_generator():
+    """Shared mask generator, built on first use."""
+    global _mask_generator
+    with _mask_generator_lock:
+        if _mask_generator is None:
+            _mask_generator = load_mask_generator()
+    return _mask_generator
 
-        box1_coords = [x1, y1, x1 + w1, y1 + h1]
-        box2_coords = [x2, y2, x2 + w2, y2 + h2]
 
-        xi1 = max(box1_coords[0], box2_coords[0])
-        yi1 = max(box1_coords[1], box2_coords[1])
-        xi2 = min(box1_coords[2], box2_coords[2])
-        yi2 = min(box1_coords[3], box2_coords[3])
+def segment_image(image_or_path, mask_generator=None):
+    """Segment MRI image (8-bit grayscale array or file path) using MedSAM2."""
+    print("\n" + "=" * 60)
+    print("STEP 1: Segmenting with MedSAM2")
+    print("=" * 60)
 
-        inter_area = max(0, xi2 - xi1) * max(0, yi2 - yi1)
+    if mask_generator is None:
+        mask_generator = get_mask_generator()
+
+    if isinstance(image_or_path, np.ndarray):
+        image = image_or_path
+    else:
+        print(f"Loading image: {image_or_path}")
+        image = cv2.imread(image_or_path, cv2.IMREAD_GRAYSCALE)
+    cv2.normalize(image, image, 0, 255, cv2.NORM_MINMAX)  # In place, 8-bit gray
+    # SAM2 wants RGB and the visualization blends into it, so the 3-channel
+    # copy is needed once; cvtColor makes it in a single pass
+    image_rgb = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
 
-        box1_area = w1 * h1
-        box2_area = w2 * h2
-        union_area = box1_area + box2_area - inter_area
+    print("Running segmentation...")
+    with _segment_lock:
+        masks = mask_generator.generate(image_rgb)
 
-        return inter_area / union_area if union_area > 0 else 0
+    print(f"✓ Found {len(masks)} regions")
+    return to_mask_set(masks, image_rgb.shape), image_rgb
+
+
+def _nms_idx_numpy(boxes, areas, order, iou_threshold):
+    """Greedy NMS over XYXY boxes visited in order; returns kept indices."""
+    # Test each candidate against all kept boxes at once
+    kept = np.empty(len(order), dtype=np.intp)
+    num_kept = 0
+    for i in order:
+        k = kept[:num_kept]
+        xx1 = np.maximum(boxes[k, 0], boxes[i, 0])
+        yy1 = np.maximum(boxes[k, 1], boxes[i, 1])
+        xx2 = np.minimum(boxes[k, 2], boxes[i, 2])
+        yy2 = np.minimum(boxes[k, 3], boxes[i, 3])
+        inter = np.clip(xx2 - xx1, 0, None) * np.clip(yy2 - yy1, 0, None)
+        union = areas[k] + areas[i] - inter
+        iou = np.divide(
+            inter, union, out=np.zeros(num_kept, dtype=np.float64), where=union > 0
+        )
+        if (iou > iou_threshold).any():
+            continue
+        kept[num_kept] = i
+        num_kept += 1
+    return kept[:num_kept]
 
-    sorted_masks = sorted(masks, key=lambda x: x["area"], reverse=True)
 
-    keep_masks = []
-    for mask in sorted_masks:
+def _nms_idx_loop(boxes, areas, order, iou_threshold):
+    """Same as _nms_idx_numpy, written as a scalar loop for numba."""
+    kept = np.empty(len(order), dtype=np.intp)
+    num_kept = 0
+    for i in order:
         overlaps = False
-        for kept_mask in keep_masks:
-            iou = compute_iou(mask["bbox"], kept_mask["bbox"])
-            if iou > iou_threshold:
+        for n in range(num_kept):
+            k = kept[n]
+            iw = min(boxes[k, 2], boxes[i, 2]) - max(boxes[k, 0], boxes[i, 0])
+            ih = min(boxes[k, 3], boxes[i, 3]) - max(boxes[k, 1], boxes[i, 1])
+            inter = max(iw, 0) * max(ih, 0)
+            union = areas[k] + areas[i] - inter
+            if union > 0 and inter / union > iou_threshold:
                 overlaps = True
                 break
-
         if not overlaps:
-            keep_masks.append(mask)
+            kept[num_kept] = i
+            num_kept += 1
+    return kept[:num_kept]
+
+
+# Compiled once and cached on disk; sub-millisecond afterwards
+_nms_idx = njit(cache=True)(_nms_idx_loop) if njit is not None else _nms_idx_numpy
+
+
+def remove_overlapping_regions(mask_set, iou_threshold=0.3):
+    """Remove overlapping masks."""
+    print("\nRemoving overlapping regions...")
+
+    # XYWH -> XYXY
+    bboxes = mask_set.bboxes
+    boxes = np.concatenate([bboxes[:, :2], bboxes[:, :2] + bboxes[:, 2:]], axis=1)
+    areas = bboxes[:, 2] * bboxes[:, 3]
 
-    print(f"Filtered {len(masks)} → {len(keep_masks)} regions")
-    return keep_masks
+    # Largest masks first
+    keep_order = _nms_idx(boxes, areas, mask_set.order, iou_threshold)
+
+    print(f"Filtered {len(mask_set.order)} → {len(keep_order)} regions")
+    return mask_set._replace(order=keep_order)
 
 
 # =============================================================================
@@ -142,21 +269,54 @@ def remove_overlapping_regions(masks, iou_threshold=0.3):
 # =============================================================================
 
 
-def create_colored_visualization(image, masks, output_path):
+def region_centroids(labels, bboxes):
+    """Centroid (x, y) of the visible pixels of labels 1..N, None if hidden.
+
+    bboxes[k] is the XYWH box of label k + 1.
+    """
+    num_regions = len(bboxes)
+
+    if num_regions >= BINCOUNT_CENTROIDS_MIN_REGIONS:
+        # All regions at once in two bincount passes over the image
+        flat_labels = labels.ravel()
+        num_labels = num_regions + 1
+        ys, xs = np.indices(labels.shape)
+        counts = np.bincount(flat_labels, minlength=num_labels)
+        sum_x = np.bincount(flat_labels, weights=xs.ravel(), minlength=num_labels)
+        sum_y = np.bincount(flat_labels, weights=ys.ravel(), minlength=num_labels)
+        return [
+            (sum_x[idx] / counts[idx], sum_y[idx] / counts[idx])
+            if counts[idx] > 0
+            else None
+            for idx in range(1, num_labels)
+        ]
+
+    # Few regions: moments over each bbox only
+    centroids = []
+    for idx, (x, y, w, h) in enumerate(bboxes, start=1):
+        # SAM2 boxes are inclusive of their right/bottom edge
+        sub = labels[y : y + h + 1, x : x + w + 1] == idx
+        m = cv2.moments(sub.astype(np.uint8), binaryImage=True)
+        if m["m00"] > 0:
+            centroids.append((x + m["m10"] / m["m00"], y + m["m01"] / m["m00"]))
+        else:
+            centroids.append(None)
+    return centroids
+
+
+def create_colored_visualization(image, mask_set, output_path):
     """Create colored mask visualization with numbers."""
     print("\n" + "=" * 60)
     print("STEP 2: Creating Colored Visualization")
     print("=" * 60)
 
     h, w = image.shape[:2]
-    colored_mask = np.zeros((h, w, 3), dtype=np.uint8)
-
-    sorted_masks = sorted(masks, key=lambda x: x["area"], reverse=True)
+    num_regions = len(mask_set.order)
 
     # Generate distinct colors
     np.random.seed(42)
     colors = []
-    for i in range(len(sorted_masks)):
+    for i in range(num_regions):
         color = [
             np.random.randint(50, 255),
             np.random.randint(50, 255),
@@ -164,36 +324,44 @@ def create_colored_visualization(image, masks, output_path):
         ]
         colors.append(color)
 
-    # Apply masks
-    for mask_dict, color in zip(sorted_masks, colors):
-        mask = mask_dict["segmentation"]
-        colored_mask[mask] = color
+    # Pack masks into one label image (0 = background, later masks on top)
+    labels = np.zeros((h, w), dtype=np.int32)
+    for idx, i in enumerate(mask_set.order, start=1):
+        labels[mask_set.segs[i]] = idx
 
-    # Blend
+    # Color every pixel with a single lookup and blend in one OpenCV pass
+    colors_lut = np.array([[0, 0, 0]] + colors, dtype=np.uint8)
     alpha = 0.5
-    blended = cv2.addWeighted(image, 1 - alpha, colored_mask, alpha, 0)
+    blended = cv2.addWeighted(
+        image, 1 - alpha, colors_lut[labels], alpha, 0, dtype=cv2.CV_8U
+    )
+
+    # Centroids of the visible part of every region
+    centroids = region_centroids(labels, mask_set.bboxes[mask_set.order])
 
     # Add numbers
-    for idx, mask_dict in enumerate(sorted_masks, start=1):
-        mask = mask_dict["segmentation"]
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale = 1.5
+    thickness = 3
+
+    # Hershey digits share one advance width, so the text size only depends
+    # on how many digits the number has
+    text_sizes = {}
 
-        y_indices, x_indices = np.where(mask)
-        if len(x_indices) > 0:
-            centroid_x = int(np.mean(x_indices))
-            centroid_y = int(np.mean(y_indices))
+    for idx, (i, centroid) in enumerate(zip(mask_set.order, centroids), start=1):
+        if centroid is not None:
+            centroid_x, centroid_y = int(centroid[0]), int(centroid[1])
         else:
-            bbox = mask_dict["bbox"]
+            bbox = mask_set.bboxes[i]
             centroid_x = int(bbox[0] + bbox[2] / 2)
             centroid_y = int(bbox[1] + bbox[3] / 2)
 
         label = str(idx)
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        font_scale = 1.5
-        thickness = 3
-
-        (text_width, text_height), _ = cv2.getTextSize(
-            label, font, font_scale, thickness
-        )
+        if len(label) not in text_sizes:
+            text_sizes[len(label)] = cv2.getTextSize(
+                label, font, font_scale, thickness
+            )[0]
+        text_width, text_height = text_sizes[len(label)]
 
         circle_radius = max(text_width, text_height) // 2 + 10
         cv2.circle(
@@ -207,11 +375,12 @@ def create_colored_visualization(image, masks, output_path):
             blended, label, (text_x, text_y), font, font_scale, (0, 0, 0), thickness
         )
 
-    cv2.imwrite(output_path, blended)
-    print(f"✓ Created visualization with {len(sorted_masks)} regions")
+    # Display only - fast DEFLATE level, still lossless
+    cv2.imwrite(output_path, blended, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    print(f"✓ Created visualization with {num_regions} regions")
     print(f"✓ Saved to: {output_path}")
 
-    return sorted_masks, colors
+    return colors, blended
 
 
 # =============================================================================
@@ -219,17 +388,18 @@ def create_colored_visualization(image, masks, output_path):
 # =============================================================================
 
 
-def label_regions_with_medgemma(image_path, num_regions):
-    """Get anatomical labels for each region."""
-    print("\n" + "=" * 60)
-    print("STEP 3: Labeling Regions with MedGemma")
-    print("=" * 60)
+def labels_max_tokens(num_regions):
+    """Decode budget for the labels answer (~30 tokens per region)."""
+    return 30 * num_regions + 100
 
-    prompt = f"""This is a medical MRI scan with {num_regions} numbered anatomical regions shown as colored masks.
+
+def build_labels_prompt(num_regions):
+    """Prompt asking MedGemma to name each numbered region."""
+    return f"""The second image shows the scan with {num_regions} numbered anatomical regions as colored masks.
 
 Carefully identify each numbered region using precise medical terminology.
 
-Respond ONLY in this format (one per line):
+List the regions in this format (one per line):
 1: [specific anatomical structure]
 2: [specific anatomical structure]
 3: [specific anatomical structure]
@@ -237,55 +407,75 @@ Respond ONLY in this format (one per line):
 
 Be specific - each number marks a different structure (bones, tendons, ligaments, soft tissues, organs, etc.)."""
 
-    print(f"Calling MedGemma for region labeling...")
-    response = ask_medgemma(
-        image_path=image_path, prompt=prompt, max_tokens=800, temperature=0.0
-    )
 
-    print(f"✓ Received labels from MedGemma")
+def parse_label_line(line):
+    """Parse one "<number>: <label>" line into (number, label), else None."""
+    line = line.strip()
+    if ":" in line:
+        parts = line.split(":", 1)
+    elif "." in line and line[:1].isdigit():
+        parts = line.split(".", 1)
+    else:
+        return None
+
+    try:
+        return int(parts[0].strip()), parts[1].strip()
+    except ValueError:
+        return None
+
 
-    # Parse labels
+def parse_region_labels(response):
+    """Parse "<number>: <label>" lines into a {number: label} dict."""
     labels = {}
     for line in response.strip().split("\n"):
-        line = line.strip()
-        if not line:
+        parsed = parse_label_line(line)
+        if parsed is None:
             continue
 
-        if ":" in line:
-            parts = line.split(":", 1)
-        elif "." in line and line[0].isdigit():
-            parts = line.split(".", 1)
-        else:
-            continue
+        region_num, label = parsed
+        if label and label not in [
+            "[specific anatomical structure]",
+            "[anatomical structure name]",
+        ]:
+            labels[region_num] = label.lower()  # Lowercase for matching
 
-        try:
-            region_num = int(parts[0].strip())
-            label = parts[1].strip()
+    return labels
 
-            if label and label not in [
-                "[specific anatomical structure]",
-                "[anatomical structure name]",
-            ]:
-                labels[region_num] = label.lower()  # Lowercase for matching
-        except (ValueError, IndexError):
-            continue
 
-    print(f"✓ Parsed {len(labels)} region labels")
-    return labels
+# Section headings of DIAGNOSIS_PROMPT - numbered lines after them are report
+REPORT_SECTION_RE = re.compile(r"^\s*(FINDINGS|IMPRESSION|RECOMMENDATIONS)\b")
+
+
+def split_leading_labels(text):
+    """Split text into (labels_text, rest) after the first block of label lines.
+
+    Lines before the first label line (an echoed "TASK 1" header, "Here are
+    the labels:") are skipped, up to the first report section heading; the
+    block ends at the next non-label line.
+    """
+    lines = text.strip().split("\n")
+    start = None
+    for i, line in enumerate(lines):
+        is_label = parse_label_line(line) is not None
+        if start is None:
+            if is_label:
+                start = i
+            elif REPORT_SECTION_RE.match(line):
+                break
+        elif line.strip() and not is_label:
+            return "\n".join(lines[start:i]), "\n".join(lines[i:])
+    if start is None:
+        return "", text
+    return "\n".join(lines[start:]), ""
 
 
 # =============================================================================
 # STEP 4: GENERATE DIAGNOSTIC REPORT
 # =============================================================================
 
+REPORT_MAX_TOKENS = 1000
 
-def generate_diagnosis_report(original_image_path):
-    """Generate diagnostic report from MedGemma."""
-    print("\n" + "=" * 60)
-    print("STEP 4: Generating Diagnostic Report")
-    print("=" * 60)
-
-    prompt = """You are an experienced radiologist analyzing this MRI scan.
+DIAGNOSIS_PROMPT = """You are an experienced radiologist analyzing this MRI scan.
 
 Provide a detailed radiology report with specific observations about each visible structure.
 
@@ -310,13 +500,67 @@ Suggest further imaging or clinical correlation if warranted.
 
 Be specific and detailed. If you see normal structures, explicitly state they are normal."""
 
-    print("Calling MedGemma for diagnostic analysis...")
-    diagnosis = ask_medgemma(
-        image_path=original_image_path, prompt=prompt, max_tokens=1000, temperature=0.3
+
+# =============================================================================
+# STEP 3 + 4: LABEL AND DIAGNOSE IN ONE CALL
+# =============================================================================
+
+LABELS_DELIMITER = "===LABELS==="
+REPORT_DELIMITER = "===REPORT==="
+
+
+def label_and_diagnose(original_image, annotated_image, num_regions):
+    """Get region labels and the diagnostic report from a single MedGemma call.
+
+    Both images (paths or in-memory PIL images) go into the same turn: the
+    report is written from the original scan, the labels from the annotated
+    one, which has the colored masks drawn over the anatomy.
+    Returns (labels, diagnosis).
+    """
+    print("\n" + "=" * 60)
+    print("STEP 3 + 4: Labeling Regions and Generating Diagnostic Report")
+    print("=" * 60)
+
+    prompt = f"""You are given two images of the same MRI scan. The first image is the original scan. The second image is the same scan annotated with numbered colored region masks.
+
+Complete BOTH tasks below.
+
+TASK 1 - REGION LABELS (use the second image)
+{build_labels_prompt(num_regions)}
+
+TASK 2 - RADIOLOGY REPORT (use the first image, the original scan)
+{DIAGNOSIS_PROMPT}
+
+Format your whole response exactly like this:
+{LABELS_DELIMITER}
+<the numbered labels from task 1>
+{REPORT_DELIMITER}
+<the radiology report from task 2>"""
+
+    print("Calling MedGemma for region labeling and diagnostic analysis...")
+    response = ask_medgemma(
+        image_path=[original_image, annotated_image],
+        prompt=prompt,
+        max_tokens=labels_max_tokens(num_regions) + REPORT_MAX_TOKENS,
+        temperature=0.0,
     )
 
+    print(f"✓ Received labels and report from MedGemma")
+
+    response = response.split(LABELS_DELIMITER, 1)[-1]
+    if REPORT_DELIMITER in response:
+        labels_text, diagnosis = response.split(REPORT_DELIMITER, 1)
+    else:
+        # Model ignored the format - only the leading numbered lines are
+        # labels, so numbered IMPRESSION items can't overwrite them
+        labels_text, diagnosis = split_leading_labels(response)
+    diagnosis = diagnosis.strip()
+
+    labels = parse_region_labels(labels_text)
+
+    print(f"✓ Parsed {len(labels)} region labels")
     print(f"✓ Generated diagnostic report ({len(diagnosis)} chars)")
-    return diagnosis
+    return labels, diagnosis
 
 
 # =============================================================================
@@ -324,6 +568,23 @@ Be specific and detailed. If you see normal structures, explicitly state they ar
 # =============================================================================
 
 
+# Common anatomical categories with their plural forms
+CATEGORY_PLURALS = {
+    "cuneiform": "cuneiforms",
+    "metatarsal": "metatarsals",
+    "phalanx": "phalanges",
+    "tarsal": "tarsal bones",
+    "tendon": "tendons",
+    "ligament": "ligaments",
+    "joint": "joints",
+}
+
+PLURAL_TO_CATEGORY = {plural: word for word, plural in CATEGORY_PLURALS.items()}
+CATEGORY_PLURALS_RE = re.compile(
+    r"\b(" + "|".join(re.escape(p) for p in PLURAL_TO_CATEGORY) + r")\b"
+)
+
+
 def match_diagnosis_to_regions(diagnosis_text, region_labels):
     """Find which regions are mentioned in the diagnosis."""
     print("\n" + "=" * 60)
@@ -332,42 +593,43 @@ def match_diagnosis_to_regions(diagnosis_text, region_labels):
 
     diagnosis_lower = diagnosis_text.lower()
 
+    # Direct match - exact labels, all found in a single scan of the text.
+    # The lookahead is zero-width, so every offset is tried and overlapping
+    # labels ("medial malleolus", "malleolus fracture") are all found.
+    # Longest labels first, so at each offset only the longest is reported;
+    # the shorter labels matching there are word-bounded prefixes of it.
+    found_labels = set()
+    unique_labels = sorted(set(region_labels.values()), key=len, reverse=True)
+    if unique_labels:
+        labels_re = re.compile(
+            r"(?=\b(" + "|".join(re.escape(l) for l in unique_labels) + r")\b)"
+        )
+        label_set = set(unique_labels)
+        for longer in {m.group(1) for m in labels_re.finditer(diagnosis_lower)}:
+            found_labels.add(longer)
+            found_labels.update(
+                longer[: b.start()]
+                for b in re.finditer(r"\b", longer)
+                if 0 < b.start() < len(longer) and longer[: b.start()] in label_set
+            )
+
+    # Category matching for plurals
+    # Check if diagnosis mentions the category that this region belongs to
+    mentioned_categories = {
+        PLURAL_TO_CATEGORY[m.group(1)]
+        for m in CATEGORY_PLURALS_RE.finditer(diagnosis_lower)
+    }
+
     matches = {}
     mentioned_terms = []
 
     for region_id, label in region_labels.items():
-        mentioned = False
-        
-        # Direct match - exact label
-        pattern = r"\b" + re.escape(label) + r"\b"
-        if re.search(pattern, diagnosis_lower):
-            mentioned = True
-        else:
-            # Category matching for plurals
-            # Check if diagnosis mentions the category that this region belongs to
-            
-            # Extract base term (remove modifiers like "first", "medial", etc.)
-            label_words = label.split()
-            
-            # Common anatomical categories with their plural forms
-            category_patterns = {
-                'cuneiform': r'\bcuneiforms\b',
-                'metatarsal': r'\bmetatarsals\b',
-                'phalanx': r'\bphalanges\b',
-                'tarsal': r'\btarsal bones\b',
-                'tendon': r'\btendons\b',
-                'ligament': r'\bligaments\b',
-                'joint': r'\bjoints\b',
-            }
-            
-            # Check if any word in the label matches a category
-            for word in label_words:
-                if word in category_patterns:
-                    plural_pattern = category_patterns[word]
-                    if re.search(plural_pattern, diagnosis_lower):
-                        mentioned = True
-                        break
-        
+        mentioned = label in found_labels
+
+        # Check if any word in the label matches a category
+        if not mentioned:
+            mentioned = any(word in mentioned_categories for word in label.split())
+
         if mentioned:
             matches[region_id] = {"label": label, "mentioned": True}
             mentioned_terms.append(label)
@@ -384,19 +646,18 @@ def match_diagnosis_to_regions(diagnosis_text, region_labels):
 # =============================================================================
 
 
-def create_output_files(masks, labels, matches, diagnosis, colors, image_name, image):
+def create_output_files(
+    mask_set, labels, matches, diagnosis, colors, image_name, image, output_dir
+):
     """Create all output files."""
     print("\n" + "=" * 60)
     print("STEP 6: Creating Output Files")
     print("=" * 60)
 
-    sorted_masks = sorted(masks, key=lambda x: x["area"], reverse=True)
-
     # Build regions data
     regions = []
-    for idx, mask_dict in enumerate(sorted_masks, start=1):
-        bbox = mask_dict["bbox"]
-        x, y, w, h = bbox
+    for idx, i in enumerate(mask_set.order, start=1):
+        x, y, w, h = mask_set.bboxes[i]
 
         label = labels.get(idx, f"unlabeled_region_{idx}")
         match_info = matches.get(idx, {"mentioned": False})
@@ -409,12 +670,12 @@ def create_output_files(masks, labels, matches, diagnosis, colors, image_name, i
             "number": idx,
             "label": label,
             "mentioned_in_diagnosis": match_info["mentioned"],
-            "bbox": [int(x), int(y), int(x + w), int(y + h)],
-            "center": [int(x + w // 2), int(y + h // 2)],
-            "area": int(mask_dict["area"]),
+            "bbox": [x, y, x + w, y + h],
+            "center": [x + w // 2, y + h // 2],
+            "area": mask_set.areas[i],
             "color": color_rgb,  # For UI to highlight exact region
-            "confidence": float(mask_dict.get("predicted_iou", 0.0)),
-            "stability": float(mask_dict.get("stability_score", 0.0)),
+            "confidence": mask_set.ious[i],
+            "stability": mask_set.stabilities[i],
         }
 
         regions.append(region_data)
@@ -425,8 +686,8 @@ def create_output_files(masks, labels, matches, diagnosis, colors, image_name, i
         "image_info": {
             "filename": f"{image_name}.png",
             "num_regions": len(regions),
-            "width": int(image_width),
-            "height": int(image_height),
+            "width": image_width,
+            "height": image_height,
         },
         "regions": regions,
         "diagnosis": {
@@ -438,10 +699,11 @@ def create_output_files(masks, labels, matches, diagnosis, colors, image_name, i
         },
     }
 
-    # Save JSON
-    with open(DEMO_OUTPUT_JSON, "w") as f:
-        json.dump(output_data, f, indent=2)
-    print(f"✓ Saved JSON to: {DEMO_OUTPUT_JSON}")
+    # Save JSON (compact; orjson serializes the NumPy scalars directly)
+    output_json = os.path.join(output_dir, OUTPUT_JSON)
+    with open(output_json, "wb") as f:
+        f.write(orjson.dumps(output_data, option=orjson.OPT_SERIALIZE_NUMPY))
+    print(f"✓ Saved JSON to: {output_json}")
 
     # Save diagnosis report
     report_header = f"""MRI ANALYSIS REPORT
@@ -453,10 +715,11 @@ Regions Mentioned in Diagnosis: {output_data["diagnosis"]["num_mentioned"]}
 
 """
 
-    with open(DEMO_OUTPUT_DIAGNOSIS, "w") as f:
+    output_diagnosis = os.path.join(output_dir, OUTPUT_DIAGNOSIS)
+    with open(output_diagnosis, "w") as f:
         f.write(report_header)
         f.write(diagnosis)
-    print(f"✓ Saved diagnosis to: {DEMO_OUTPUT_DIAGNOSIS}")
+    print(f"✓ Saved diagnosis to: {output_diagnosis}")
 
     return output_data
 
@@ -466,64 +729,122 @@ Regions Mentioned in Diagnosis: {output_data["diagnosis"]["num_mentioned"]}
 # =============================================================================
 
 
-def main():
-    """Run the complete pipeline."""
+def run(
+    image_or_path,
+    output_dir,
+    mask_generator=None,
+    copy_original=True,
+    image_name="upload",
+):
+    """Run the complete pipeline on one image and return the output data.
+
+    image_or_path is an image file or an already decoded 8-bit grayscale
+    array (image_name then names it in the outputs). For files,
+    copy_original places the input image in output_dir as well (the demo
+    UI loads it from there).
+    """
+    input_path = None
+    if not isinstance(image_or_path, np.ndarray):
+        input_path = image_or_path
+        if not os.path.exists(input_path):
+            raise FileNotFoundError(f"Input image not found: {input_path}")
+        image_name = Path(input_path).stem
+
+    os.makedirs(output_dir, exist_ok=True)
+    output_visualization = os.path.join(output_dir, OUTPUT_VISUALIZATION)
+
+    # Step 1: Segment with MedSAM2
+    mask_set, image = segment_image(image_or_path, mask_generator)
+    mask_set = remove_overlapping_regions(mask_set, iou_threshold=0.3)
+    num_regions = len(mask_set.order)
+
+    # Step 2: Visualize
+    colors, visualization = create_colored_visualization(
+        image, mask_set, output_visualization
+    )
+
+    # Steps 3 + 4: Label regions and generate diagnosis (from memory, the
+    # PNG on disk is only for the UI). The report is read off the clean
+    # image, not the tinted and numbered one.
+    region_labels, diagnosis = label_and_diagnose(
+        Image.fromarray(image), Image.fromarray(visualization), num_regions
+    )
+
+    # Step 5: Match diagnosis to regions
+    matches, mentioned_terms = match_diagnosis_to_regions(diagnosis, region_labels)
+
+    # Step 6: Create outputs
+    output_data = create_output_files(
+        mask_set,
+        region_labels,
+        matches,
+        diagnosis,
+        colors,
+        image_name,
+        image,
+        output_dir,
+    )
+
+    # Put the original image next to the outputs (hardlink when possible)
+    if copy_original and input_path is not None:
+        original_output = os.path.join(output_dir, os.path.basename(input_path))
+        already_there = os.path.exists(original_output) and os.path.samefile(
+            input_path, original_output
+        )
+        if not already_there:
+            if os.path.exists(original_output):
+                os.unlink(original_output)
+            try:
+                os.link(input_path, original_output)
+            except OSError:
+                import shutil
+                shutil.copy(input_path, original_output)
+
     print("\n" + "=" * 60)
-    print("DEMO GENERATION PIPELINE")
-    print("Segmentation → Labeling → Diagnosis → Region Matching")
+    print("PIPELINE COMPLETE!")
     print("=" * 60)
-    print(f"Demo Input: {DEMO_INPUT_IMAGE}")
-    print(f"Demo Output: {DEMO_OUTPUT_DIR}")
-    print(f"Device: {DEVICE}")
+    print(f"✓ Segmented regions: {num_regions}")
+    print(f"✓ Labeled regions: {len(region_labels)}")
+    print(
+        f"✓ Regions mentioned in diagnosis: {output_data['diagnosis']['num_mentioned']}"
+    )
+    print(f"\nMentioned regions: {', '.join(mentioned_terms)}")
+    print(f"\nFiles saved to:")
+    print(f"  1. {output_visualization}")
+    print(f"  2. {os.path.join(output_dir, OUTPUT_JSON)}")
+    print(f"  3. {os.path.join(output_dir, OUTPUT_DIAGNOSIS)}")
 
-    if not os.path.exists(DEMO_INPUT_IMAGE):
-        print(f"\n❌ Error: Demo input image not found: {DEMO_INPUT_IMAGE}")
-        return
+    return output_data
 
-    try:
-        # Step 1: Segment with MedSAM2
-        masks, image = segment_image(DEMO_INPUT_IMAGE)
-        masks = remove_overlapping_regions(masks, iou_threshold=0.3)
 
-        # Step 2: Visualize
-        sorted_masks, colors = create_colored_visualization(
-            image, masks, DEMO_OUTPUT_VISUALIZATION
-        )
+def parse_args():
+    """Parse the input image and output directory from the command line."""
+    parser = argparse.ArgumentParser(description="MedSAM2 + MedGemma MRI pipeline")
+    parser.add_argument("--input", default=DEMO_INPUT_IMAGE, help="MRI image to analyze")
+    parser.add_argument(
+        "--output-dir", default=DEMO_OUTPUT_DIR, help="Where to write the outputs"
+    )
+    return parser.parse_args()
 
-        # Step 3: Label regions
-        region_labels = label_regions_with_medgemma(
-            DEMO_OUTPUT_VISUALIZATION, len(sorted_masks)
-        )
 
-        # Step 4: Generate diagnosis
-        diagnosis = generate_diagnosis_report(DEMO_INPUT_IMAGE)
+def main():
+    """Run the complete pipeline (generates the web-app demo by default)."""
+    args = parse_args()
 
-        # Step 5: Match diagnosis to regions
-        matches, mentioned_terms = match_diagnosis_to_regions(diagnosis, region_labels)
+    print("\n" + "=" * 60)
+    print("DEMO GENERATION PIPELINE")
+    print("Segmentation → Labeling → Diagnosis → Region Matching")
+    print("=" * 60)
+    print(f"Input: {args.input}")
+    print(f"Output: {args.output_dir}")
+    print(f"Device: {DEVICE}")
 
-        # Step 6: Create outputs
-        image_name = Path(DEMO_INPUT_IMAGE).stem
-        output_data = create_output_files(
-            sorted_masks, region_labels, matches, diagnosis, colors, image_name, image
-        )
-        
-        # Copy original image to demo folder
-        import shutil
-        shutil.copy(DEMO_INPUT_IMAGE, DEMO_OUTPUT_ORIGINAL)
+    if not os.path.exists(args.input):
+        print(f"\n❌ Error: Input image not found: {args.input}")
+        return
 
-        print("\n" + "=" * 60)
-        print("DEMO GENERATION COMPLETE!")
-        print("=" * 60)
-        print(f"✓ Segmented regions: {len(sorted_masks)}")
-        print(f"✓ Labeled regions: {len(region_labels)}")
-        print(
-            f"✓ Regions mentioned in diagnosis: {output_data['diagnosis']['num_mentioned']}"
-        )
-        print(f"\nMentioned regions: {', '.join(mentioned_terms)}")
-        print(f"\nDemo files saved to:")
-        print(f"  1. {DEMO_OUTPUT_VISUALIZATION}")
-        print(f"  2. {DEMO_OUTPUT_JSON}")
-        print(f"  3. {DEMO_OUTPUT_DIAGNOSIS}")
+    try:
+        run(args.input, args.output_dir)
 
         print("\n" + "=" * 60)
         print("Ready for interactive UI!")
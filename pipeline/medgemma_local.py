@@ -1,13 +1,37 @@
 #!/usr/bin/env python3
 """Local MedGemma Inference Module"""
 
+import hashlib
 import os
+import threading
+from collections import OrderedDict
 
 import torch
 from PIL import Image
 from transformers import AutoModelForCausalLM
 from transformers.models.gemma3.processing_gemma3 import Gemma3Processor
 
+if torch.cuda.is_available():
+    DEVICE = "cuda"
+elif torch.backends.mps.is_available():
+    DEVICE = "mps"
+else:
+    DEVICE = "cpu"
+
+# Weight format: "int8" (weight-only quantization) or "bf16" (original weights)
+QUANTIZATION = os.environ.get("MEDGEMMA_QUANTIZATION", "int8").lower()
+if QUANTIZATION not in ("int8", "bf16"):
+    raise ValueError(
+        f"MEDGEMMA_QUANTIZATION must be 'int8' or 'bf16', got {QUANTIZATION!r}"
+    )
+
+# Preprocessed images kept in memory (the same MRI is usually asked about
+# more than once)
+PIXEL_CACHE_SIZE = 8
+
+# Templated prompts kept in memory (the pipeline only uses a few)
+CHAT_TEXT_CACHE_SIZE = 32
+
 
 class LocalMedGemma:
     """Local MedGemma model runner."""
@@ -17,75 +41,164 @@ class LocalMedGemma:
         print("Loading MedGemma Model Locally")
         print("=" * 60)
         print(f"Model: {model_id}")
-        print("Device: MPS (Apple Silicon)")
+        print(f"Device: {DEVICE}")
+        print(f"Weights: {QUANTIZATION}")
         print("\nThis will download ~8GB on first run...")
         print("=" * 60 + "\n")
 
         print("Loading processor...")
         self.processor = Gemma3Processor.from_pretrained(model_id)
 
-        print("Loading model to MPS...")
-        self.model = AutoModelForCausalLM.from_pretrained(
+        print(f"Loading model to {DEVICE}...")
+        self.model = self._load_model(model_id)
+
+        # One generate() at a time on the shared model
+        self._lock = threading.Lock()
+
+        self._pixel_cache = OrderedDict()
+        self._pixel_cache_lock = threading.Lock()
+
+        self._chat_text_cache = OrderedDict()
+        self._chat_text_cache_lock = threading.Lock()
+
+        print("✓ MedGemma loaded successfully!\n")
+
+    def _load_model(self, model_id):
+        """Load the model, int8-quantized unless MEDGEMMA_QUANTIZATION=bf16."""
+        if QUANTIZATION == "int8" and DEVICE == "cuda":
+            # Only the import is guarded, so load errors aren't reported as
+            # a missing package
+            try:
+                import bitsandbytes  # noqa: F401
+            except ImportError:
+                print("bitsandbytes not installed, using bfloat16 weights")
+            else:
+                from transformers import BitsAndBytesConfig
+
+                return AutoModelForCausalLM.from_pretrained(
+                    model_id,
+                    quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+                    device_map="auto",
+                    low_cpu_mem_usage=True,
+                )
+
+        model = AutoModelForCausalLM.from_pretrained(
             model_id,
             torch_dtype=torch.bfloat16,
-            device_map="mps",
+            device_map=DEVICE,
             low_cpu_mem_usage=True,
         )
 
-        print("✓ MedGemma loaded successfully!\n")
-
-    def generate(self, image_path, prompt, max_tokens=500, temperature=0.0):
-        """Generate response from MedGemma."""
-        image = Image.open(image_path).convert("RGB")
-
+        # bitsandbytes is CUDA-only, quantize with torchao everywhere else
+        if QUANTIZATION == "int8" and DEVICE != "cuda":
+            try:
+                import torchao  # noqa: F401
+            except ImportError:
+                print("torchao not installed, using bfloat16 weights")
+            else:
+                from torchao.quantization import Int8WeightOnlyConfig, quantize_
+
+                quantize_(model, Int8WeightOnlyConfig())
+
+        return model
+
+    def _chat_text(self, prompt, num_images=1):
+        """Chat template for prompt, with the image placeholders expanded."""
+        key = (prompt, num_images)
+        with self._chat_text_cache_lock:
+            text = self._chat_text_cache.get(key)
+            if text is not None:
+                self._chat_text_cache.move_to_end(key)
+                return text
+
+        content = [{"type": "image"}] * num_images
         messages = [
-            {
-                "role": "user",
-                "content": [{"type": "image"}, {"type": "text", "text": prompt}],
-            }
+            {"role": "user", "content": content + [{"type": "text", "text": prompt}]}
         ]
 
         text = self.processor.apply_chat_template(
             messages, tokenize=False, add_generation_prompt=True
         )
 
-        inputs = self.processor(text=text, images=image, return_tensors="pt").to("mps")
+        # Same expansion Gemma3Processor does when it is given the images
+        text = text.replace(self.processor.boi_token, self.processor.full_image_sequence)
+
+        with self._chat_text_cache_lock:
+            self._chat_text_cache[key] = text
+            if len(self._chat_text_cache) > CHAT_TEXT_CACHE_SIZE:
+                self._chat_text_cache.popitem(last=False)
+        return text
+
+    def _pixel_values(self, image):
+        """Resize + normalize image for the vision tower, cached by content."""
+        key = (image.size, hashlib.blake2b(image.tobytes(), digest_size=8).digest())
+        with self._pixel_cache_lock:
+            pixel_values = self._pixel_cache.get(key)
+            if pixel_values is not None:
+                self._pixel_cache.move_to_end(key)
+                return pixel_values
+
+        image_inputs = self.processor.image_processor(image, return_tensors="pt")
+        pixel_values = image_inputs["pixel_values"].to(self.model.device)
+
+        with self._pixel_cache_lock:
+            self._pixel_cache[key] = pixel_values
+            if len(self._pixel_cache) > PIXEL_CACHE_SIZE:
+                self._pixel_cache.popitem(last=False)
+        return pixel_values
+
+    def generate(self, image_path, prompt, max_tokens=500, temperature=0.0):
+        """Generate response from MedGemma.
+
+        image_path may be a PIL image, or a list of images/paths that go
+        into the same turn, in order, before the prompt.
+        """
+        if not isinstance(image_path, (list, tuple)):
+            image_path = [image_path]
+        images = [
+            img.convert("RGB")
+            if isinstance(img, Image.Image)
+            else Image.open(img).convert("RGB")
+            for img in image_path
+        ]
+
+        # Text only - the image placeholder tokens are already in the text
+        inputs = self.processor(
+            text=self._chat_text(prompt, len(images)), return_tensors="pt"
+        ).to(self.model.device)
+        inputs["pixel_values"] = torch.cat([self._pixel_values(img) for img in images])
+        input_len = inputs["input_ids"].shape[1]
 
         print("Generating response...")
-        with torch.no_grad():
+        with self._lock, torch.no_grad():
             outputs = self.model.generate(
                 **inputs,
-                max_new_tokens=1000,
-                min_new_tokens=100,
+                max_new_tokens=max_tokens,
+                min_new_tokens=min(20, max_tokens // 4),
                 do_sample=False,
                 num_beams=1,
                 pad_token_id=self.processor.tokenizer.eos_token_id,
                 eos_token_id=self.processor.tokenizer.eos_token_id,
-                early_stopping=False,
+                use_cache=True,
             )
 
-        response = self.processor.batch_decode(outputs, skip_special_tokens=True)[0]
-
-        # Remove the prompt echo
-        if text in response:
-            response = response.replace(text, "").strip()
-
-        # Remove conversation markers
-        if "model\n" in response:
-            response = response.split("model\n")[-1].strip()
-
-        response = response.replace("user\n", "").strip()
+        # Decode only the new tokens, so there is no prompt echo to strip
+        response = self.processor.batch_decode(
+            outputs[:, input_len:], skip_special_tokens=True
+        )[0]
 
-        return response
+        return response.strip()
 
 
 _model_instance = None
+_model_instance_lock = threading.Lock()
 
 
 def get_medgemma():
     global _model_instance
-    if _model_instance is None:
-        _model_instance = LocalMedGemma()
+    with _model_instance_lock:
+        if _model_instance is None:
+            _model_instance = LocalMedGemma()
     return _model_instance
 
 